@@ -1,8 +1,11 @@
-import requests
-import time
+import aiohttp
+import asyncio
 import logging
-from typing import Tuple, Optional
+import hashlib
+import re
+from typing import Tuple, Optional, Dict, List
 from dataclasses import dataclass
+from datetime import datetime, timezone
 import os
 from geopy.geocoders import Nominatim
 from geopy.exc import GeocoderTimedOut, GeocoderQuotaExceeded
@@ -15,6 +18,20 @@ GOOGLE_API_KEY = os.getenv('GOOGLE_MAPS_API_KEY')
 SUPABASE_URL = os.getenv('SUPABASE_URL')
 SUPABASE_KEY = os.getenv('SUPABASE_KEY')
 
+# Concurrent Google requests; keep within the API key's QPS quota
+GEOCODE_CONCURRENCY = int(os.getenv('GEOCODE_CONCURRENCY', '10'))
+GEOCODE_MAX_RETRIES = 4
+# Rows per Supabase upsert request
+UPSERT_CHUNK_SIZE = 500
+
+# Address abbreviations expanded by clean_address, matched as whole words in one pass
+_ADDRESS_ABBREVIATIONS = {
+    'Jln': 'Jalan',
+    'KL': 'Kuala Lumpur',
+    'PJ': 'Petaling Jaya'
+}
+_ADDRESS_ABBREVIATIONS_RE = re.compile(r'\b(' + '|'.join(map(re.escape, _ADDRESS_ABBREVIATIONS)) + r')\b')
+
 # Setup logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
@@ -32,8 +49,53 @@ class GeocodingService:
             raise ValueError("Supabase URL and Key must be set in environment variables.")
         self.supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
         self.google_api_key = GOOGLE_API_KEY
+        self._cache: Dict[str, Coordinates] = self.load_geocode_cache()
+        self._new_cache_entries: Dict[str, Coordinates] = {}
         logger.info("Geocoding service initialized with Supabase")
 
+    def load_geocode_cache(self) -> Dict[str, Coordinates]:
+        """Load previously geocoded addresses from Supabase"""
+        try:
+            response = self.supabase.table("geocode_cache").select("address_hash, lat, lng, accuracy").execute()
+            rows = response.data or []
+            logger.info(f"Loaded {len(rows)} cached geocodes")
+            return {
+                row['address_hash']: Coordinates(
+                    latitude=row['lat'],
+                    longitude=row['lng'],
+                    accuracy=row.get('accuracy') or "unknown"
+                )
+                for row in rows
+            }
+        except Exception as e:
+            logger.warning(f"Failed to load geocode cache: {e}")
+            return {}
+
+    @staticmethod
+    def address_key(cleaned_address: str) -> str:
+        """Cache key for a cleaned address"""
+        return hashlib.blake2b(cleaned_address.encode(), digest_size=16).hexdigest()
+
+    def save_geocode_cache(self, new_entries: Dict[str, Coordinates]):
+        """Bulk-upsert newly geocoded addresses into the Supabase cache"""
+        ts = datetime.now(timezone.utc).isoformat()
+        rows = [
+            {
+                "address_hash": key,
+                "lat": coordinates.latitude,
+                "lng": coordinates.longitude,
+                "accuracy": coordinates.accuracy,
+                "ts": ts
+            }
+            for key, coordinates in new_entries.items()
+        ]
+        for start in range(0, len(rows), UPSERT_CHUNK_SIZE):
+            chunk = rows[start:start + UPSERT_CHUNK_SIZE]
+            try:
+                self.supabase.table("geocode_cache").upsert(chunk).execute()
+            except Exception as e:
+                logger.warning(f"Failed to cache {len(chunk)} geocodes: {e}")
+
     def get_outlets_without_coordinates(self):
         """Get outlets from Supabase that don't have coordinates yet"""
         response = self.supabase.table("outlets").select("id, name, address").is_("latitude", None).execute()
@@ -41,7 +103,7 @@ class GeocodingService:
         logger.info(f"Found {len(outlets)} outlets without coordinates")
         return outlets
 
-    def geocode_with_google(self, address: str) -> Optional[Coordinates]:
+    async def geocode_with_google(self, session: aiohttp.ClientSession, sem: asyncio.Semaphore, address: str) -> Optional[Coordinates]:
         """Geocode address using Google Maps Geocoding API"""
         if not self.google_api_key:
             return None
@@ -51,10 +113,16 @@ class GeocodingService:
                 'address': f"{address}",
                 'key': self.google_api_key
             }
-            response = requests.get(url, params=params, timeout=10)
-            response.raise_for_status()
-            data = response.json()
-            print(data)
+            async with sem:
+                for attempt in range(GEOCODE_MAX_RETRIES):
+                    async with session.get(url, params=params) as response:
+                        response.raise_for_status()
+                        data = await response.json()
+                    if data['status'] != 'OVER_QUERY_LIMIT' or attempt == GEOCODE_MAX_RETRIES - 1:
+                        break
+                    # Back off only when Google signals we are over the rate limit
+                    await asyncio.sleep(2 ** attempt)
+            logger.debug("Google geocoding response: %s", data)
             if data['status'] == 'OK' and data['results']:
                 result = data['results'][0]
                 location = result['geometry']['location']
@@ -64,7 +132,7 @@ class GeocodingService:
                     accuracy="google"
                 )
             return None
-        except requests.RequestException as e:
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
             logger.warning(f"Google geocoding request failed: {e}")
             return None
         except Exception as e:
@@ -76,58 +144,74 @@ class GeocodingService:
         if not address:
             return ""
         cleaned = ' '.join(address.split())
-        replacements = {
-            'Jln': 'Jalan',
-            'Taman': 'Taman',
-            'KL': 'Kuala Lumpur',
-            'PJ': 'Petaling Jaya'
-        }
-        for old, new in replacements.items():
-            cleaned = cleaned.replace(old, new)
-        return cleaned
-
-    def update_outlet_coordinates(self, outlet_id: int, coordinates: Coordinates):
-        """Update outlet coordinates in Supabase"""
+        return _ADDRESS_ABBREVIATIONS_RE.sub(lambda m: _ADDRESS_ABBREVIATIONS[m.group(0)], cleaned)
+
+    def update_outlet_coordinates(self, updates: List[Dict]):
+        """Bulk-update outlet coordinates in Supabase"""
+        updated_count = 0
+        for start in range(0, len(updates), UPSERT_CHUNK_SIZE):
+            chunk = updates[start:start + UPSERT_CHUNK_SIZE]
+            try:
+                response = self.supabase.table("outlets").upsert(chunk, on_conflict="id").execute()
+                updated_ids = {row['id'] for row in response.data or []}
+                updated_count += len(updated_ids)
+                for row in chunk:
+                    if row['id'] not in updated_ids:
+                        logger.error(f"Failed to update coordinates for outlet ID {row['id']}")
+            except Exception as e:
+                logger.error(f"Error updating coordinates for {len(chunk)} outlets: {e}")
+        logger.info(f"Updated coordinates for {updated_count} outlets")
+        return updated_count
+
+    async def geocode_one(self, session: aiohttp.ClientSession, sem: asyncio.Semaphore, outlet) -> Optional[Coordinates]:
+        """Geocode a single outlet, using the cache when possible"""
+        name = outlet['name']
+        address = outlet['address']
         try:
-            update_data = {
-                "latitude": coordinates.latitude,
-                "longitude": coordinates.longitude
-            }
-            response = self.supabase.table("outlets").update(update_data).eq("id", outlet_id).execute()
-            if response.data:
-                logger.info(f"Updated coordinates for outlet ID {outlet_id}")
-            else:
-                logger.error(f"Failed to update coordinates for outlet ID {outlet_id}: {response}")
+            logger.info(f"Processing outlet: {name}")
+            cleaned_address = self.clean_address(address)
+            key = self.address_key(cleaned_address)
+            coordinates = self._cache.get(key)
+            if not coordinates:
+                coordinates = await self.geocode_with_google(session, sem, cleaned_address)
+                if not coordinates:
+                    logger.warning(f"Failed to geocode outlet: {name}")
+                    return None
+                # Saved to Supabase in bulk once the whole run finishes
+                self._cache[key] = coordinates
+                self._new_cache_entries[key] = coordinates
+            return coordinates
         except Exception as e:
-            logger.error(f"Error updating coordinates for outlet {outlet_id}: {e}")
+            logger.error(f"Error processing outlet {name}: {e}")
+            return None
 
-    def geocode_all_outlets(self):
+    async def geocode_all_outlets(self):
         """Geocode all outlets without coordinates using Google Maps only"""
         outlets = self.get_outlets_without_coordinates()
         if not outlets:
             logger.info("All outlets already have coordinates")
             return
-        successful_geocodes = 0
-        failed_geocodes = 0
-        for outlet in outlets:
-            outlet_id = outlet['id']
-            name = outlet['name']
-            address = outlet['address']
-            try:
-                logger.info(f"Processing outlet: {name}")
-                cleaned_address = self.clean_address(address)
-                coordinates = self.geocode_with_google(cleaned_address)
-                if coordinates:
-                    self.update_outlet_coordinates(outlet_id, coordinates)
-                    successful_geocodes += 1
-                else:
-                    failed_geocodes += 1
-                    logger.warning(f"Failed to geocode outlet: {name}")
-                time.sleep(2)
-            except Exception as e:
-                logger.error(f"Error processing outlet {name}: {e}")
-                failed_geocodes += 1
-                continue
+        sem = asyncio.Semaphore(GEOCODE_CONCURRENCY)
+        connector = aiohttp.TCPConnector(limit=GEOCODE_CONCURRENCY)
+        timeout = aiohttp.ClientTimeout(total=10)
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+            results = await asyncio.gather(*[self.geocode_one(session, sem, o) for o in outlets])
+        # name/address are included so the upsert satisfies the NOT NULL columns
+        updates = [
+            {
+                "id": outlet['id'],
+                "name": outlet['name'],
+                "address": outlet['address'],
+                "latitude": coordinates.latitude,
+                "longitude": coordinates.longitude
+            }
+            for outlet, coordinates in zip(outlets, results) if coordinates
+        ]
+        if self._new_cache_entries:
+            self.save_geocode_cache(self._new_cache_entries)
+            self._new_cache_entries = {}
+        successful_geocodes = self.update_outlet_coordinates(updates) if updates else 0
+        failed_geocodes = len(outlets) - successful_geocodes
         logger.info(f"Geocoding completed. Success: {successful_geocodes}, Failed: {failed_geocodes}")
 
     def cleanup(self):
@@ -137,7 +221,7 @@ def main():
     """Main function to run geocoding"""
     geocoder = GeocodingService()
     try:
-        geocoder.geocode_all_outlets()
+        asyncio.run(geocoder.geocode_all_outlets())
     except Exception as e:
         logger.error(f"Error during geocoding: {e}")
     finally:
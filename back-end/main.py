@@ -7,7 +7,7 @@ Serves outlet data with geographical coordinates and provides chatbot functional
 from fastapi import FastAPI, HTTPException, Query, Depends, Body
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, NamedTuple
 from pydantic import BaseModel, Field
 from datetime import datetime
 import logging
@@ -15,7 +15,11 @@ from contextlib import asynccontextmanager
 import os
 from supabase import create_client, Client
 import math
-import requests
+import re
+import asyncio
+import threading
+import time
+import httpx
 from dotenv import load_dotenv
 import uvicorn
 import numpy as np
@@ -37,6 +41,22 @@ supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
 GROQ_API_KEY = os.getenv("GROQ_API_KEY")
 HUGGINGFACE_TOKEN = os.getenv("HF_TOKEN")
 EMBED_URL = "https://router.huggingface.co/hf-inference/models/sentence-transformers/all-MiniLM-L6-v2/pipeline/feature-extraction"
+GROQ_URL = "https://api.groq.com/openai/v1/chat/completions"
+
+# Shared HTTP clients so Groq and Hugging Face calls reuse pooled TLS connections.
+# The sync client backs get_hf_embedding; request handlers use the async client
+# created in lifespan (app.state.http).
+HTTP_LIMITS = httpx.Limits(max_connections=100, max_keepalive_connections=20)
+http_client = httpx.Client(http2=True, timeout=30.0, limits=HTTP_LIMITS)
+
+EARTH_RADIUS_KM = 6371
+
+# Outlet cache config
+OUTLET_REFRESH_INTERVAL_SECONDS = int(os.getenv("OUTLET_REFRESH_INTERVAL_SECONDS", "3600"))
+# Short TTL so serverless instances, where the background refresh may never run, stay fresh
+OUTLET_CACHE_TTL_SECONDS = int(os.getenv("OUTLET_CACHE_TTL_SECONDS", "60"))
+
+_refresh_lock = threading.RLock()
 
 # Pydantic models
 class Outlet(BaseModel):
@@ -62,20 +82,36 @@ class ChatRequest(BaseModel):
 class ChatResponse(BaseModel):
     answer: str
 
-# Haversine formula to calculate distance between two lat/lng points
-def haversine(lat1, lon1, lat2, lon2):
-    R = 6371  # Earth radius in km
+# Haversine formula to calculate distance from one query point to many lat/lng points
+def haversine_vec(lat1, lon1, lats, lons):
+    R = EARTH_RADIUS_KM
+    # Query-point terms are constant across outlets, so compute them once as scalars
     phi1 = math.radians(lat1)
-    phi2 = math.radians(lat2)
-    dphi = math.radians(lat2 - lat1)
-    dlambda = math.radians(lon2 - lon1)
-    a = math.sin(dphi/2)**2 + math.cos(phi1)*math.cos(phi2)*math.sin(dlambda/2)**2
-    c = 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
+    cos_phi1 = math.cos(phi1)
+    phi2 = np.radians(lats)
+    dphi = phi2 - phi1
+    dlambda = np.radians(lons - lon1)
+    a = np.sin(dphi/2)**2 + cos_phi1*np.cos(phi2)*np.sin(dlambda/2)**2
+    c = 2 * np.arcsin(np.sqrt(a))
     return R * c
 
+def to_unit_sphere(lats, lons):
+    """Project lat/lng (degrees) onto 3-D points on the unit sphere"""
+    lat = np.radians(lats)
+    lon = np.radians(lons)
+    return np.stack(
+        [np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)], -1
+    ).astype(np.float32)
+
+def build_geo_index(coords):
+    """FAISS index over outlet positions; L2 distance is the chord between points"""
+    index = faiss.IndexFlatL2(3)
+    index.add(to_unit_sphere(coords[:, 0], coords[:, 1])) # type: ignore
+    return index
+
 def get_hf_embedding(texts: list[str]):
     headers = {"Authorization": f"Bearer {HUGGINGFACE_TOKEN}"}
-    resp = requests.post(EMBED_URL, headers=headers, json={"inputs": texts})
+    resp = http_client.post(EMBED_URL, headers=headers, json={"inputs": texts})
     resp.raise_for_status()
     data = resp.json()
     return data  # List of embeddings
@@ -95,10 +131,113 @@ def build_vector_store(outlets):
 
     return index, outlet_texts
 
+def _fetch_outlets():
+    """Fetch all outlets from Supabase"""
+    response = supabase.table("outlets").select("*").execute()
+    return response.data or []
+
+class OutletSnapshot(NamedTuple):
+    """One generation of the outlet cache; replaced as a whole, never mutated"""
+    outlets: List[Dict[str, Any]]
+    located_outlets: List[Dict[str, Any]]
+    coords: np.ndarray
+    geo_index: Any
+    compressed_context: str
+    loaded_at: float
+
+def build_outlet_snapshot(outlets):
+    """Derive the lookup structures for a freshly fetched outlet list"""
+    # Coordinates of geocoded outlets for vectorized distance queries
+    located = [o for o in outlets if o.get("latitude") is not None and o.get("longitude") is not None]
+    coords = np.array(
+        [(o["latitude"], o["longitude"]) for o in located], dtype=np.float64
+    ).reshape(-1, 2)
+
+    return OutletSnapshot(
+        outlets=outlets,
+        located_outlets=located,
+        coords=coords,
+        geo_index=build_geo_index(coords),
+        # Compressed LLM context (Name|Location|Hours per line), built once per refresh
+        compressed_context="\n".join(compress_outlet_data(outlets)),
+        loaded_at=time.monotonic(),
+    )
+
+def refresh_outlet_cache():
+    """Reload outlets from Supabase and publish them as a new snapshot"""
+    with _refresh_lock:
+        snapshot = build_outlet_snapshot(_fetch_outlets())
+        # A single assignment, so readers holding the old snapshot never see a mix
+        app.state.snapshot = snapshot
+        logger.info(f"Loaded {len(snapshot.outlets)} outlets into cache")
+
+def snapshot_stale(snapshot):
+    return snapshot is None or time.monotonic() - snapshot.loaded_at > OUTLET_CACHE_TTL_SECONDS
+
+def get_outlet_snapshot():
+    """Return the cached snapshot, reloading it once older than OUTLET_CACHE_TTL_SECONDS"""
+    snapshot = app.state.snapshot
+    if snapshot_stale(snapshot):
+        with _refresh_lock:
+            snapshot = app.state.snapshot
+            if snapshot_stale(snapshot):
+                try:
+                    refresh_outlet_cache()
+                except Exception as e:
+                    if snapshot is None:
+                        raise
+                    logger.warning(f"Serving stale outlets, refresh failed: {e}")
+                snapshot = app.state.snapshot
+    return snapshot
+
+def refresh_stale_snapshot():
+    """Reload an expired snapshot unless another refresh is already in flight"""
+    if not _refresh_lock.acquire(blocking=False):
+        return
+    try:
+        snapshot = app.state.snapshot
+        if snapshot_stale(snapshot):
+            try:
+                refresh_outlet_cache()
+            except Exception as e:
+                # Keep serving the old snapshot and retry after another TTL, not on every request
+                logger.warning(f"Serving stale outlets, refresh failed: {e}")
+                app.state.snapshot = snapshot._replace(loaded_at=time.monotonic())
+    finally:
+        _refresh_lock.release()
+
+async def get_outlet_snapshot_async():
+    """Snapshot for async handlers; only a cold start waits for Supabase"""
+    snapshot = app.state.snapshot
+    if snapshot is None:
+        return await asyncio.to_thread(get_outlet_snapshot)
+    if snapshot_stale(snapshot):
+        # Serve the current snapshot and reload in a worker thread, off the request path
+        asyncio.get_running_loop().run_in_executor(None, refresh_stale_snapshot)
+    return snapshot
+
+async def refresh_periodically():
+    while True:
+        await asyncio.sleep(OUTLET_REFRESH_INTERVAL_SECONDS)
+        try:
+            await asyncio.to_thread(refresh_outlet_cache)
+        except Exception as e:
+            logger.error(f"Error refreshing outlet cache: {e}")
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     logger.info("Starting Subway Outlet API")
+    app.state.snapshot = None
+    app.state.http = httpx.AsyncClient(http2=True, timeout=30.0, limits=HTTP_LIMITS)
+    try:
+        await asyncio.to_thread(refresh_outlet_cache)
+    except Exception as e:
+        logger.error(f"Error loading outlet cache: {e}")
+    refresh_task = asyncio.create_task(refresh_periodically())
     yield
+    refresh_task.cancel()
+    await app.state.http.aclose()
+    http_client.close()
     logger.info("Shutting down Subway Outlet API")
 
 # FastAPI app
@@ -123,37 +262,45 @@ app.add_middleware(
 )
 
 @app.get("/outlets", response_model=List[Outlet])
-def get_all_outlets():
-    """Get all outlets from Supabase"""
+async def get_all_outlets():
+    """Get all outlets (served from the TTL outlet cache)"""
     try:
-        response = supabase.table("outlets").select("*").execute()
-        outlets = response.data or []
-        return outlets
+        snapshot = await get_outlet_snapshot_async()
+        return snapshot.outlets
     except Exception as e:
         logger.error(f"Error fetching outlets: {e}")
         raise HTTPException(status_code=500, detail="Failed to fetch outlets")
 
 @app.get("/outlets/nearby", response_model=List[OutletWithDistance])
-def get_nearby_outlets(
+async def get_nearby_outlets(
     latitude: float = Query(..., description="Latitude of the location"),
     longitude: float = Query(..., description="Longitude of the location"),
     distance_km: float = Query(5, description="Search radius in kilometers")
 ):
     """Find nearby outlets within a given distance (default 5km)"""
     try:
-        response = supabase.table("outlets").select("*").not_.is_("latitude", None).not_.is_("longitude", None).execute()
-        outlets = response.data or []
+        snapshot = await get_outlet_snapshot_async()
+        located = snapshot.located_outlets
+        coords = snapshot.coords
+
+        # Range search on the unit sphere: a great-circle radius maps to a chord length,
+        # padded by ~6m so float32 rounding never drops a boundary outlet
+        query_point = to_unit_sphere(np.array([latitude]), np.array([longitude]))
+        angle = min(distance_km / EARTH_RADIUS_KM, np.pi)
+        chord = 2 * np.sin(angle / 2) + 1e-6
+        lims, _, candidates = snapshot.geo_index.range_search(query_point, float(chord ** 2))
+        candidates = candidates[lims[0]:lims[1]]
+
+        # Exact float64 distances for the candidates only
+        dist = np.full(len(located), np.inf)
+        dist[candidates] = haversine_vec(latitude, longitude, coords[candidates, 0], coords[candidates, 1])
+        within = np.flatnonzero(dist <= distance_km)
+        order = within[np.argsort(dist[within], kind="stable")]
         results = []
-        for outlet in outlets:
-            lat = outlet.get("latitude")
-            lng = outlet.get("longitude")
-            if lat is not None and lng is not None:
-                dist = haversine(latitude, longitude, lat, lng)
-                if dist <= distance_km:
-                    outlet_with_distance = dict(outlet)
-                    outlet_with_distance["distance_km"] = round(dist, 3)
-                    results.append(outlet_with_distance)
-        results.sort(key=lambda x: x["distance_km"])
+        for i in order:
+            outlet_with_distance = dict(located[i])
+            outlet_with_distance["distance_km"] = round(float(dist[i]), 3)
+            results.append(outlet_with_distance)
         return results
     except Exception as e:
         logger.error(f"Error finding nearby outlets: {e}")
@@ -190,29 +337,37 @@ def extract_location_keywords(address):
     found_locations = [loc for loc in locations if loc.lower() in address.lower()]
     return found_locations[0] if found_locations else address[:20]
 
+# Closing time patterns, compiled once and reused for every outlet
+_CLOSING_TIME_PATTERNS = [
+    re.compile(r'(\d{1,2}:\d{2}\s*[AP]M)'),
+    re.compile(r'(\d{1,2}[AP]M)'),
+    re.compile(r'(\d{1,2}:\d{2})'),
+]
+
+# Patterns to match different time formats, with hour/minute/AM-PM groups
+_NORMALIZED_TIME_PATTERNS = [
+    re.compile(r'(\d{1,2}):(\d{2})\s*([AP]M)'),  # 10:00 PM
+    re.compile(r'(\d{1,2})\s*([AP]M)'),          # 10 PM
+    re.compile(r'(\d{1,2}):(\d{2})'),            # 22:00
+]
+
 def extract_closing_time(hours):
     """Extract closing time from operating hours"""
     if not hours:
         return "Unknown"
     
     # Simple regex to find closing time patterns like "10PM", "22:00", etc.
-    import re
-    patterns = [
-        r'(\d{1,2}:\d{2}\s*[AP]M)',
-        r'(\d{1,2}[AP]M)',
-        r'(\d{1,2}:\d{2})',
-    ]
-    
-    for pattern in patterns:
-        matches = re.findall(pattern, hours.upper())
+    for pattern in _CLOSING_TIME_PATTERNS:
+        matches = pattern.findall(hours.upper())
         if matches:
             return matches[-1]  # Return the last time (likely closing time)
     
     return hours[:10]  # Fallback to first 10 chars
 @app.post("/chat-completion", response_model=ChatResponse)
-def chat_completion(request: ChatRequest):
+async def chat_completion(request: ChatRequest):
     try:
-        outlets = get_all_outlets()
+        snapshot = await get_outlet_snapshot_async()
+        outlets = snapshot.outlets
         query_lower = request.query.lower()
         
         # Try direct processing first for specific question types
@@ -221,7 +376,7 @@ def chat_completion(request: ChatRequest):
             return ChatResponse(answer=direct_answer)
         
         # Fall back to LLM processing with optimized context
-        return handle_llm_processing(request, outlets)
+        return await handle_llm_processing(request, snapshot)
     except Exception as e:
         logger.error(f"Error in chat_completion: {e}")
         raise HTTPException(status_code=500, detail="Failed to process chat completion request")
@@ -267,9 +422,6 @@ def handle_counting_directly(query_lower: str, outlets):
 
 def handle_latest_closing_directly(outlets):
     """Find outlets with latest closing time directly"""
-    import re
-    from datetime import datetime
-    
     outlet_times = []
     for outlet in outlets:
         name = outlet.get('name', 'Unknown')
@@ -300,18 +452,9 @@ def extract_and_normalize_closing_time(hours_str):
     if not hours_str:
         return None
     
-    import re
-    
-    # Patterns to match different time formats
-    patterns = [
-        r'(\d{1,2}):(\d{2})\s*([AP]M)',  # 10:00 PM
-        r'(\d{1,2})\s*([AP]M)',          # 10 PM
-        r'(\d{1,2}):(\d{2})',            # 22:00
-    ]
-    
     times_found = []
-    for pattern in patterns:
-        matches = re.findall(pattern, hours_str.upper())
+    for pattern in _NORMALIZED_TIME_PATTERNS:
+        matches = pattern.findall(hours_str.upper())
         for match in matches:
             if len(match) == 3:  # Hour, minute, AM/PM
                 hour, minute, ampm = match
@@ -336,17 +479,14 @@ def extract_and_normalize_closing_time(hours_str):
     
     return max(times_found) if times_found else None
 
-def handle_llm_processing(request: ChatRequest, outlets):
+async def handle_llm_processing(request: ChatRequest, snapshot: OutletSnapshot):
     """Handle questions that need LLM processing with optimized context"""
-    # Use compressed data approach
-    compressed_outlets = compress_outlet_data(outlets)
-    
-    # Build context with compressed data
+    # Build context with compressed data precomputed on cache refresh
     context = f"""
-Total outlets: {len(outlets)}
+Total outlets: {len(snapshot.outlets)}
 
 Outlet Data (Name|Location|Hours):
-{chr(10).join(compressed_outlets)}
+{snapshot.compressed_context}
 """
     
     prompt = f"""
@@ -366,7 +506,6 @@ Answer:
 """
     
     # Call Groq API
-    url = "https://api.groq.com/openai/v1/chat/completions"
     headers = {
         "Content-Type": "application/json",
         "Authorization": f"Bearer {GROQ_API_KEY}"
@@ -376,7 +515,7 @@ Answer:
         "messages": [{"role": "user", "content": prompt}],
         "max_tokens": 256,
     }
-    response = requests.post(url, headers=headers, json=payload, timeout=30)
+    response = await app.state.http.post(GROQ_URL, headers=headers, json=payload)
     response.raise_for_status()
     data = response.json()
     content = data["choices"][0]["message"]["content"]
@@ -6,20 +6,19 @@ Scrapes Subway outlet data from subway.com.my with Kuala Lumpur filter
 
 from multiprocessing.connection import Client
 import sqlite3
-import time
 import json
+from concurrent.futures import ThreadPoolExecutor
 import re
-from bs4 import BeautifulSoup
+from selectolax.lexbor import LexborHTMLParser
 from selenium import webdriver
 from selenium.webdriver.common.by import By
 from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
 from selenium.webdriver.chrome.options import Options
-from selenium.common.exceptions import TimeoutException, NoSuchElementException
+from selenium.common.exceptions import TimeoutException, NoSuchElementException, StaleElementReferenceException
 from dataclasses import dataclass
 from typing import List, Optional
 import logging
-from bs4.element import Tag
 from dotenv import load_dotenv
 import os
 from supabase import create_client, Client
@@ -34,6 +33,25 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(
 logger = logging.getLogger(__name__)
 
 
+OUTLET_SELECTOR = "[class*='fp_listitem']"
+PAGE_HTML_SCRIPT = "return document.documentElement.outerHTML;"
+NEXT_PAGE_SELECTORS = [
+    "a[aria-label*='next']",
+    ".next",
+    ".pagination-next",
+    ".page-next",
+    "[class*='next']"
+]
+# ':contains' is not valid CSS, so text matching uses XPath
+NEXT_PAGE_XPATH = "//a[contains(text(),'Next')]"
+
+# Class names that look like outlet containers, for the page_source fallback
+_OUTLET_CLASS_RE = re.compile(r'store|outlet|location|shop', re.I)
+FIRST_OUTLET_HTML_SCRIPT = (
+    f"const e = document.querySelector(\"{OUTLET_SELECTOR}\"); return e ? e.outerHTML : null;"
+)
+
+
 @dataclass
 class SubwayOutlet:
     name: str
@@ -41,11 +59,52 @@ class SubwayOutlet:
     operating_hours: str
     waze_link: Optional[str] = None
 
+def outlet_from_node(node) -> Optional[SubwayOutlet]:
+    """Extract outlet information from a parsed outlet element"""
+    try:
+        name_node = node.css_first('h4')
+        name = name_node.text(strip=True) if name_node else ""
+        p_texts = [p.text(strip=True) for p in node.css('.infoboxcontent p')]
+        hrefs = [a.attributes.get('href') or '' for a in node.css('.directionButton a')]
+
+        # Address (first <p> in .infoboxcontent)
+        address = p_texts[0] if p_texts else ""
+
+        # Operating hours (all <p> in .infoboxcontent except first and last)
+        hours = [text for text in p_texts[1:-1] if text]
+        operating_hours = " | ".join(hours) if hours else "Not specified"
+
+        # Waze link
+        waze_link = None
+        for href in hrefs:
+            if href and isinstance(href, str) and 'waze.com' in href:
+                waze_link = href
+                break
+
+
+        if name and address:
+            # print(f"Extracted outlet: {name}, Address: {address}, Hours: {operating_hours}, Waze: {waze_link}")
+            return SubwayOutlet(
+                name=name,
+                address=address,
+                operating_hours=operating_hours,
+                waze_link=waze_link,
+            )
+        return None
+    except Exception as e:
+        logger.error(f"Error extracting outlet info: {e}")
+        return None
+
+
 class SubwayScraper:
     def __init__(self, headless=True):
         self.base_url = "https://subway.com.my/find-a-subway"
         self.outlets = []
         self.setup_driver(headless)
+        # Reusable waits; list_wait polls fast since list re-renders are quick
+        self.wait = WebDriverWait(self.driver, 10)
+        self.short_wait = WebDriverWait(self.driver, 5)
+        self.list_wait = WebDriverWait(self.driver, 10, poll_frequency=0.1)
         self.setup_supabase()
     
     def setup_driver(self, headless=True):
@@ -58,6 +117,18 @@ class SubwayScraper:
         chrome_options.add_argument("--disable-gpu")
         chrome_options.add_argument("--window-size=1920,1080")
         chrome_options.add_argument("--user-agent=Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36")
+        chrome_options.add_argument("--disable-extensions")
+        chrome_options.add_argument("--disable-background-networking")
+        chrome_options.add_argument("--disable-sync")
+        # Skip images, which the text scrape never reads. Stylesheets stay
+        # enabled: is_displayed() checks on pagination buttons depend on CSS.
+        chrome_options.add_argument("--blink-settings=imagesEnabled=false")
+        chrome_options.add_experimental_option("prefs", {
+            "profile.managed_default_content_settings.images": 2,
+        })
+        # Return from driver.get at DOMContentLoaded; the explicit waits on the
+        # search input and outlet list cover what the scrape actually needs
+        chrome_options.page_load_strategy = 'eager'
         
         try:
             self.driver = webdriver.Chrome(options=chrome_options)
@@ -75,25 +146,43 @@ class SubwayScraper:
 
     def save_to_database(self, outlets):
         """Save scraped outlets to Supabase"""
-        saved_count = 0
+        # Key by the conflict columns: Postgres rejects an upsert batch that
+        # touches the same row twice, so collapse duplicate (name, address) rows first
+        rows = {}
         for outlet in outlets:
-            try:
-                data = {
-                    "name": outlet.name or "",
-                    "address": outlet.address or "",
-                    "operating_hours": outlet.operating_hours or "",
-                    "waze_link": outlet.waze_link or "",
-                }
+            data = {
+                "name": outlet.name or "",
+                "address": outlet.address or "",
+                "operating_hours": outlet.operating_hours or "",
+                "waze_link": outlet.waze_link or "",
+            }
+            rows[(data["name"], data["address"])] = data
+        rows = list(rows.values())
+        if not rows:
+            return 0
 
+        try:
+            response = self.supabase.table("outlets").upsert(rows, on_conflict="name,address").execute()
+            saved_count = len(response.data or [])
+        except Exception as e:
+            logger.warning(f"Batch upsert failed, retrying row by row: {e}")
+            saved_count = self.save_rows_individually(rows)
+        logger.info(f"Saved {saved_count} outlets to Supabase")
+        return saved_count
+
+    def save_rows_individually(self, rows):
+        """Fallback for a failed batch: upsert rows one at a time to isolate bad ones"""
+        saved_count = 0
+        for data in rows:
+            try:
                 response = self.supabase.table("outlets").upsert(data, on_conflict="name,address").execute()
                 if response.data:
                     saved_count += 1
                 else:
                     logger.error(f"Supabase error: {response.data}")
             except Exception as e:
-                logger.error(f"Error saving outlet {outlet.name}: {e}")
+                logger.error(f"Error saving outlet {data['name']}: {e}")
                 continue
-        logger.info(f"Saved {saved_count} outlets to Supabase")
         return saved_count
     
     def filter_by_kuala_lumpur(self):
@@ -103,12 +192,12 @@ class SubwayScraper:
             self.driver.get(self.base_url)
             
             # Wait for page to load
-            WebDriverWait(self.driver, 10).until(
+            self.wait.until(
                 EC.presence_of_element_located((By.TAG_NAME, "body"))
             )
 
             try:
-                search_input = WebDriverWait(self.driver, 5).until(
+                search_input = self.short_wait.until(
                     EC.presence_of_element_located((By.CSS_SELECTOR, "input[id*='fp_searchAddress']"))
                 )
             except TimeoutException:
@@ -119,13 +208,13 @@ class SubwayScraper:
                 logger.info("Found search input, entering 'Kuala Lumpur'")
                 search_input.clear()
                 search_input.send_keys("Kuala Lumpur")
-                time.sleep(2)
                 
                 try:
                     search_btn = self.driver.find_element(By.CSS_SELECTOR, "button[id*='fp_searchAddressBtn']")
+                    previous_first_outlet = self.first_outlet_html()
                     search_btn.click()
-                    time.sleep(3)
                     logger.info("Clicked search button")
+                    self.wait_for_outlet_list_change(previous_first_outlet)
                 except NoSuchElementException:
                     logger.warning(f"Search button not found with selector")
             
@@ -134,43 +223,47 @@ class SubwayScraper:
             return False
         return True
     
+    def first_outlet_html(self):
+        """Outer HTML of the first outlet list item, or None if the list is empty"""
+        return self.driver.execute_script(FIRST_OUTLET_HTML_SCRIPT)
+    
+    def wait_for_outlet_list_change(self, previous_first_outlet):
+        """Wait until the outlet list re-renders, i.e. its first item differs from before"""
+        def list_changed(driver):
+            first_outlet = driver.execute_script(FIRST_OUTLET_HTML_SCRIPT)
+            return first_outlet is not None and first_outlet != previous_first_outlet
+        
+        try:
+            self.list_wait.until(list_changed)
+            return True
+        except TimeoutException:
+            logger.warning("Timed out waiting for outlet list to update")
+            return False
+    
     def scrape_outlet_data(self):
         """Scrape outlet data from current page"""
-        outlets_on_page = []
-        
         try:
-            try:
-                elements = self.driver.find_elements(By.CSS_SELECTOR, "[class*='fp_listitem']")
-                if elements:
-                    outlet_elements = elements
-                    logger.info(f"Found {len(elements)} outlets using selector: [class*='fp_listitem']")
-                    
-            except:
-                logger.warning("Failed to find outlets using primary selector, trying alternative methods")
-                outlet_elements = []
+            # Pull the rendered DOM once and parse it in-process: no per-outlet CDP calls
+            page_html = self.driver.execute_script(PAGE_HTML_SCRIPT)
+            tree = LexborHTMLParser(page_html)
             
-            if not outlet_elements:
-                # Fallback: scrape from page source
-                page_source = self.driver.page_source
-                soup = BeautifulSoup(page_source, 'html.parser')
-                
-                # Look for patterns in the HTML
-                potential_containers = soup.find_all(['div', 'li', 'article'], 
-                    class_=re.compile(r'store|outlet|location|shop', re.I))
-                
-                if potential_containers:
-                    logger.info(f"Found {len(potential_containers)} potential outlet containers")
-                    outlet_elements = potential_containers
+            outlet_nodes = tree.css(OUTLET_SELECTOR)
+            if outlet_nodes:
+                logger.info(f"Found {len(outlet_nodes)} outlets using selector: {OUTLET_SELECTOR}")
+            else:
+                logger.warning("Failed to find outlets using primary selector, trying alternative methods")
+                # Fallback: look for patterns in the class names
+                outlet_nodes = [
+                    node for node in tree.css('div, li, article')
+                    if _OUTLET_CLASS_RE.search(node.attributes.get('class') or '')
+                ]
+                if outlet_nodes:
+                    logger.info(f"Found {len(outlet_nodes)} potential outlet containers")
             
-            for element in outlet_elements:
-                try:
-                    outlet_data = self.extract_outlet_info(element)
-                    if outlet_data and outlet_data.name and outlet_data.address:
-                        outlets_on_page.append(outlet_data)
-                        logger.info(f"Extracted outlet: {outlet_data.name}")
-                except Exception as e:
-                    logger.warning(f"Error extracting outlet data: {e}")
-                    continue
+            outlets_on_page = [o for o in (outlet_from_node(node) for node in outlet_nodes) if o and o.name and o.address]
+            logger.info(f"Extracted {len(outlets_on_page)} outlets")
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f"Extracted outlets: {', '.join(o.name for o in outlets_on_page)}")
             
             return outlets_on_page
             
@@ -178,57 +271,24 @@ class SubwayScraper:
             logger.error(f"Error scraping outlet data: {e}")
             return []
     
-    def extract_outlet_info(self, element):
-        """Extract outlet information from HTML element (BeautifulSoup Tag or Selenium WebElement)"""
-        try:
-            # Convert Selenium element to BeautifulSoup if needed
-            if not hasattr(element, 'find'):
-                html = element.get_attribute('outerHTML')
-                soup_element = BeautifulSoup(html, 'html.parser')
-            else:
-                soup_element = element
-
-            # Name
-            name_elem = soup_element.select_one('h4')
-            name = name_elem.get_text(strip=True) if name_elem else ""
-
-            # Address (first <p> in .infoboxcontent)
-            address_elem = soup_element.select_one('.infoboxcontent p')
-            address = address_elem.get_text(strip=True) if address_elem else ""
-
-            # Operating hours (all <p> in .infoboxcontent except first and last)
-            p_tags = soup_element.select('.infoboxcontent p')
-            hours = []
-            for p in p_tags[1:-1]:
-                text = p.get_text(strip=True)
-                if text:
-                    hours.append(text)
-            operating_hours = " | ".join(hours) if hours else "Not specified"
-
-            # Waze link
-            waze_link = None
-            for a in soup_element.select('.directionButton a'):
-                href = a.get('href', '')
-                if href and isinstance(href, str) and 'waze.com' in href:
-                    waze_link = href
-                    break
-
-
-            if name and address:
-                # print(f"Extracted outlet: {name}, Address: {address}, Hours: {operating_hours}, Waze: {waze_link}")
-                return SubwayOutlet(
-                    name=name,
-                    address=address,
-                    operating_hours=operating_hours,
-                    waze_link=waze_link,
-                )
-            return None
-        except Exception as e:
-            logger.error(f"Error extracting outlet info: {e}")
-            return None
+    def find_next_button(self):
+        """First visible, enabled next-page control, or None"""
+        # Selectors are tried in priority order (a combined query would return matches
+        # in document order instead); find_elements returns [] rather than raising,
+        # and the XPath covers links labelled "Next"
+        candidates = [(By.CSS_SELECTOR, selector) for selector in NEXT_PAGE_SELECTORS]
+        candidates.append((By.XPATH, NEXT_PAGE_XPATH))
+        for by, selector in candidates:
+            for button in self.driver.find_elements(by, selector):
+                try:
+                    if button.is_displayed() and button.is_enabled():
+                        return button
+                except StaleElementReferenceException:
+                    continue
+        return None
     
-    def handle_pagination(self):
-        """Handle pagination to scrape all pages"""
+    def handle_pagination(self, on_page=None):
+        """Handle pagination to scrape all pages, passing each page's outlets to on_page as soon as it is scraped"""
         all_outlets = []
         page_num = 1
         
@@ -244,37 +304,27 @@ class SubwayScraper:
             
             all_outlets.extend(outlets_on_page)
             logger.info(f"Found {len(outlets_on_page)} outlets on page {page_num}")
+            if on_page:
+                on_page(outlets_on_page)
             
             # Look for next page button
-            next_button_found = False
-            next_selectors = [
-                "a[aria-label*='next']",
-                ".next",
-                ".pagination-next",
-                "a:contains('Next')",
-                ".page-next",
-                "[class*='next']"
-            ]
-            
-            for selector in next_selectors:
-                try:
-                    next_button = self.driver.find_element(By.CSS_SELECTOR, selector)
-                    if next_button.is_enabled() and next_button.is_displayed():
-                        self.driver.execute_script("arguments[0].click();", next_button)
-                        time.sleep(3)
-                        next_button_found = True
-                        logger.info(f"Clicked next button, moving to page {page_num + 1}")
-                        break
-                except NoSuchElementException:
-                    continue
-                except Exception as e:
-                    logger.warning(f"Error clicking next button: {e}")
-                    continue
-            
-            if not next_button_found:
+            next_button = self.find_next_button()
+            if not next_button:
                 logger.info("No more pages found")
                 break
             
+            previous_first_outlet = self.first_outlet_html()
+            try:
+                self.driver.execute_script("arguments[0].click();", next_button)
+            except Exception as e:
+                logger.warning(f"Error clicking next button: {e}")
+                break
+            logger.info(f"Clicked next button, moving to page {page_num + 1}")
+            if not self.wait_for_outlet_list_change(previous_first_outlet):
+                # Scraping again would just re-read the page we already have
+                logger.info("Outlet list did not change after clicking next, stopping pagination")
+                break
+            
             page_num += 1
             
             # Safety limit
@@ -294,12 +344,27 @@ class SubwayScraper:
                 logger.error("Failed to filter by Kuala Lumpur")
                 return
             
-            # Handle pagination and scrape all pages
-            all_outlets = self.handle_pagination()
+            # Handle pagination and scrape all pages, saving each page to the
+            # database in the background while the next one is scraped
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                save_futures = []
+                seen = set()
+
+                def save_page(outlets):
+                    # Only submit outlets not saved from an earlier page, so saved_count counts unique rows
+                    new_outlets = []
+                    for outlet in outlets:
+                        key = (outlet.name or "", outlet.address or "")
+                        if key not in seen:
+                            seen.add(key)
+                            new_outlets.append(outlet)
+                    if new_outlets:
+                        save_futures.append(executor.submit(self.save_to_database, new_outlets))
+
+                all_outlets = self.handle_pagination(on_page=save_page)
+                saved_count = sum(future.result() for future in save_futures)
             
             if all_outlets:
-                # Save to database
-                saved_count = self.save_to_database(all_outlets)
                 logger.info(f"Scraping completed. Total outlets scraped: {len(all_outlets)}, Saved: {saved_count}")
             else:
                 logger.warning("No outlets were scraped")